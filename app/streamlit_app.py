@@ -5,10 +5,12 @@ Interactive visualization of transaction anomalies in Brazilian e-commerce data
 
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+import io
 import sys
+import time
 from pathlib import Path
 
 # Add parent directory to path for imports
@@ -127,16 +129,169 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
-@st.cache_data(ttl=3600)
-def load_and_process_data():
-    """Load data and run anomaly detection (cached for performance)"""
+@st.cache_resource(ttl=3600)
+def load_detector():
+    """Load data and run anomaly detection (shared across reruns, read-only)"""
     detector = RetailAnomalyDetector(contamination=0.05)
     detector.load_data()
     detector.fit_isolation_forest()
     detector.add_statistical_flags()
+
+    # Purchase date as int32 days since epoch, so the date filter is an
+    # integer compare instead of a per-row datetime.date conversion
+    detector.df['order_date_ord'] = (
+        detector.df['order_purchase_timestamp'].values
+        .astype('datetime64[D]').astype(np.int32)
+    )
+
+    # Single-precision copy of the amount for the range filter and histogram;
+    # the float64 column stays for the model, KPIs and exports
+    detector.df['total_amount_f32'] = detector.df['total_amount'].astype(np.float32)
+
+    # Plain numpy bools so flag sums take NumPy's reduction fast path
+    for col in ['is_anomaly_ml', 'is_anomaly_iqr']:
+        detector.df[col] = detector.df[col].astype(np.bool_)
+
+    # Identifies this load in the filter-keyed aggregate caches below, so a
+    # reloaded detector never shares entries with the one it replaced
+    detector.data_version = time.time_ns()
+
+    # Full-dataset summaries do not depend on the sidebar filters
+    detector.summary_stats = detector.get_summary_stats()
+    detector.top_states = state_aggregate(detector.df)
     return detector
 
 
+def top_k(values, k):
+    """Indices of the k largest values, largest first, without a full sort"""
+    if len(values) > k:
+        idx = np.argpartition(-values, k - 1)[:k]
+    else:
+        idx = np.arange(len(values))
+    return idx[np.argsort(-values[idx], kind='stable')]
+
+
+def state_aggregate(df, top=12):
+    """Top states by anomaly count, with their anomaly rate"""
+    states = df['customer_state'].cat
+    codes = states.codes.values
+    known = codes >= 0
+    codes = codes[known]
+
+    n_states = len(states.categories)
+    totals = np.bincount(codes, minlength=n_states)
+    anomalies = np.bincount(
+        codes, weights=df['is_anomaly_ml'].values[known], minlength=n_states
+    ).astype(np.int64)
+
+    idx = top_k(anomalies, top)
+    return states.categories[idx].to_numpy(), anomalies[idx], anomalies[idx] / totals[idx] * 100
+
+
+def apply_filters(df, state, anomaly_type, amount_range, date_range):
+    """Apply sidebar filter selections to the orders frame"""
+    # Build a single boolean mask over the raw arrays and index the frame once
+    amounts = df['total_amount_f32'].values
+    mask = (amounts >= np.float32(amount_range[0])) & (amounts <= np.float32(amount_range[1]))
+    if state != 'All':
+        states = df['customer_state'].cat
+        mask &= states.codes.values == states.categories.get_loc(state)
+    if anomaly_type != 'All':
+        types = df['anomaly_type'].cat
+        mask &= types.codes.values == types.categories.get_loc(anomaly_type)
+    if len(date_range) == 2:
+        days = df['order_date_ord'].values
+        d0 = np.datetime64(date_range[0], 'D').astype(np.int32)
+        d1 = np.datetime64(date_range[1], 'D').astype(np.int32)
+        mask &= (days >= d0) & (days <= d1)
+    return df.iloc[mask]
+
+
+def binned_counts(values, groups, bins=50):
+    """Histogram counts of values per group over shared bin edges"""
+    edges = np.histogram_bin_edges(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    counts = {
+        group: np.histogram(values[groups == group], bins=edges)[0]
+        for group in np.unique(groups)
+    }
+    return centers, counts
+
+
+# Aggregations are cached on the (hashable) filter selections rather than on
+# the filtered frame, so revisiting a filter combination skips the groupby.
+# The detector's data_version is part of the key and entries expire with the
+# detector. Chart builders only ever receive these small aggregated arrays.
+@st.cache_data(ttl=3600, max_entries=64)
+def amount_histogram(data_version, state, anomaly_type, amount_range, date_range):
+    """Order amount histogram split by ML flag for a filter selection"""
+    df = apply_filters(load_detector().df, state, anomaly_type, amount_range, date_range)
+
+    # Bin on the Python side so only ~50 bars per series reach the browser
+    return binned_counts(df['total_amount_f32'].values, df['is_anomaly_ml'].values)
+
+
+@st.cache_data(ttl=3600, max_entries=64)
+def score_histogram(data_version, state, anomaly_type, amount_range, date_range):
+    """Anomaly score histogram split by anomaly type for a filter selection"""
+    df = apply_filters(load_detector().df, state, anomaly_type, amount_range, date_range)
+    types = df['anomaly_type'].cat
+    centers, counts = binned_counts(df['anomaly_probability'].values, types.codes.values)
+    return centers, {types.categories[code]: c for code, c in counts.items()}
+
+
+@st.cache_data(ttl=3600, max_entries=64)
+def monthly_aggregate(data_version, state, anomaly_type, amount_range, date_range):
+    """Monthly order and anomaly counts for a filter selection"""
+    df = apply_filters(load_detector().df, state, anomaly_type, amount_range, date_range)
+
+    # Group on a datetime64[M] key rather than a PeriodIndex; labels are
+    # formatted afterwards on the (small) aggregated result
+    months = df['order_purchase_timestamp'].values.astype('datetime64[M]')
+    monthly = df.groupby(months).agg(
+        orders=('order_id', 'size'),
+        anomalies=('is_anomaly_ml', 'sum')
+    )
+    labels = np.datetime_as_string(monthly.index.values, unit='M')
+    return labels, monthly['orders'].to_numpy(), monthly['anomalies'].to_numpy()
+
+
+@st.cache_data(ttl=3600, max_entries=64)
+def hourly_aggregate(data_version, state, anomaly_type, amount_range, date_range):
+    """Hourly order and anomaly counts for a filter selection"""
+    df = apply_filters(load_detector().df, state, anomaly_type, amount_range, date_range)
+    # hour_of_day is a dense 0-23 key, so a 24-bucket bincount replaces the groupby
+    hours = df['hour_of_day'].values
+    orders = np.bincount(hours, minlength=24)
+    anomalies = np.bincount(hours, weights=df['is_anomaly_ml'].values, minlength=24)
+    present = orders > 0
+    return np.flatnonzero(present), orders[present], anomalies[present].astype(np.int64)
+
+
+@st.cache_data(ttl=3600, max_entries=64)
+def type_aggregate(data_version, state, anomaly_type, amount_range, date_range):
+    """Order counts per anomaly type for a filter selection"""
+    df = apply_filters(load_detector().df, state, anomaly_type, amount_range, date_range)
+    types = df['anomaly_type'].cat
+    counts = np.bincount(types.codes.values, minlength=len(types.categories))
+    present = counts > 0
+    return tuple(types.categories[present]), counts[present]
+
+
+@st.cache_data(ttl=3600, max_entries=16)
+def anomalies_csv(data_version, state, anomaly_type, amount_range, date_range):
+    """CSV export of ML-flagged orders for a filter selection"""
+    df = apply_filters(load_detector().df, state, anomaly_type, amount_range, date_range)
+    anomaly_df = df[df['is_anomaly_ml'].values].sort_values(
+        'anomaly_probability', ascending=False
+    ).drop(columns=['order_date_ord', 'total_amount_f32'])
+
+    # Write straight to bytes to skip the intermediate str
+    buffer = io.BytesIO()
+    anomaly_df.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
 def create_kpi_metrics(stats, filtered_stats=None):
     """Display KPI metrics in columns"""
     col1, col2, col3, col4 = st.columns(4)
@@ -171,19 +326,29 @@ def create_kpi_metrics(stats, filtered_stats=None):
         )
 
 
-def create_distribution_chart(df):
+def create_distribution_chart(histogram):
     """Create order amount distribution histogram"""
-    fig = px.histogram(
-        df,
-        x='total_amount',
-        color='is_anomaly_ml',
-        nbins=50,
-        color_discrete_map={True: COLORS['anomaly'], False: COLORS['normal']},
-        labels={'is_anomaly_ml': 'Anomaly', 'total_amount': 'Order Amount (R$)'}
-    )
+    centers, counts = histogram
+
+    fig = go.Figure()
+    for is_anomaly, name, color in [
+        (False, 'Normal', COLORS['normal']),
+        (True, 'Anomaly', COLORS['anomaly'])
+    ]:
+        if is_anomaly in counts:
+            fig.add_trace(go.Bar(
+                x=centers,
+                y=counts[is_anomaly],
+                name=name,
+                marker_color=color
+            ))
+
     fig.update_layout(
         title=dict(text='Order Amount Distribution', font=dict(size=16)),
+        barmode='stack',
         bargap=0.05,
+        xaxis_title='Order Amount (R$)',
+        yaxis_title='Count',
         legend=dict(
             orientation="h",
             yanchor="bottom",
@@ -200,7 +365,7 @@ def create_distribution_chart(df):
     return fig
 
 
-def create_anomaly_score_chart(df):
+def create_anomaly_score_chart(histogram):
     """Create anomaly score distribution"""
     color_map = {
         'Normal': COLORS['normal'],
@@ -209,16 +374,23 @@ def create_anomaly_score_chart(df):
         'High Confidence Anomaly': COLORS['anomaly']
     }
 
-    fig = px.histogram(
-        df,
-        x='anomaly_probability',
-        color='anomaly_type',
-        nbins=50,
-        color_discrete_map=color_map,
-        labels={'anomaly_probability': 'Anomaly Score'}
-    )
+    centers, counts = histogram
+
+    fig = go.Figure()
+    for anomaly_type, type_counts in counts.items():
+        fig.add_trace(go.Bar(
+            x=centers,
+            y=type_counts,
+            name=anomaly_type,
+            marker_color=color_map.get(anomaly_type, COLORS['secondary'])
+        ))
+
     fig.update_layout(
         title=dict(text='Anomaly Score Distribution', font=dict(size=16)),
+        barmode='stack',
+        bargap=0,
+        xaxis_title='Anomaly Score',
+        yaxis_title='Count',
         legend=dict(
             orientation="h",
             yanchor="bottom",
@@ -236,23 +408,17 @@ def create_anomaly_score_chart(df):
     return fig
 
 
-def create_time_series_chart(df):
+def create_time_series_chart(monthly):
     """Create time series with dual axis for orders and anomaly rate"""
-    monthly = df.groupby(
-        df['order_purchase_timestamp'].dt.to_period('M')
-    ).agg({
-        'order_id': 'count',
-        'is_anomaly_ml': 'sum'
-    }).reset_index()
-    monthly['order_purchase_timestamp'] = monthly['order_purchase_timestamp'].astype(str)
-    monthly['anomaly_rate'] = monthly['is_anomaly_ml'] / monthly['order_id'] * 100
+    months, orders, anomalies = monthly
+    anomaly_rate = anomalies / orders * 100
 
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
     fig.add_trace(
         go.Bar(
-            x=monthly['order_purchase_timestamp'],
-            y=monthly['order_id'],
+            x=months,
+            y=orders,
             name='Total Orders',
             marker_color=COLORS['normal'],
             opacity=0.7
@@ -262,8 +428,8 @@ def create_time_series_chart(df):
 
     fig.add_trace(
         go.Scatter(
-            x=monthly['order_purchase_timestamp'],
-            y=monthly['anomaly_rate'],
+            x=months,
+            y=anomaly_rate,
             name='Anomaly Rate %',
             line=dict(color=COLORS['anomaly'], width=3),
             mode='lines+markers',
@@ -293,21 +459,21 @@ def create_time_series_chart(df):
     return fig
 
 
-def create_state_chart(state_summary):
+def create_state_chart(top_states):
     """Create bar chart of anomalies by state"""
-    data = state_summary.head(12).reset_index()
+    states, anomaly_count, anomaly_rate = top_states
 
     fig = go.Figure()
 
     fig.add_trace(go.Bar(
-        x=data['customer_state'],
-        y=data['anomaly_count'],
+        x=states,
+        y=anomaly_count,
         marker=dict(
-            color=data['anomaly_rate'],
+            color=anomaly_rate,
             colorscale=[[0, COLORS['normal']], [1, COLORS['anomaly']]],
             colorbar=dict(title='Rate %', thickness=15)
         ),
-        text=data['anomaly_count'],
+        text=anomaly_count,
         textposition='outside',
         textfont=dict(size=10)
     ))
@@ -325,21 +491,18 @@ def create_state_chart(state_summary):
     return fig
 
 
-def create_hourly_chart(df):
+def create_hourly_chart(hourly):
     """Create hourly distribution of anomalies"""
-    hourly = df.groupby('hour_of_day').agg({
-        'order_id': 'count',
-        'is_anomaly_ml': 'sum'
-    }).reset_index()
-    hourly['anomaly_rate'] = hourly['is_anomaly_ml'] / hourly['order_id'] * 100
+    hours, orders, anomalies = hourly
+    anomaly_rate = anomalies / orders * 100
 
     fig = go.Figure()
 
     fig.add_trace(go.Bar(
-        x=hourly['hour_of_day'],
-        y=hourly['anomaly_rate'],
+        x=hours,
+        y=anomaly_rate,
         marker=dict(
-            color=hourly['anomaly_rate'],
+            color=anomaly_rate,
             colorscale=[[0, COLORS['normal']], [0.5, COLORS['warning']], [1, COLORS['anomaly']]]
         )
     ))
@@ -357,10 +520,9 @@ def create_hourly_chart(df):
     return fig
 
 
-def create_type_breakdown_chart(df):
+def create_type_breakdown_chart(type_counts):
     """Create anomaly type breakdown"""
-    type_counts = df['anomaly_type'].value_counts().reset_index()
-    type_counts.columns = ['type', 'count']
+    types, counts = type_counts
 
     color_map = {
         'Normal': COLORS['normal'],
@@ -368,11 +530,11 @@ def create_type_breakdown_chart(df):
         'Statistical Outlier': COLORS['warning'],
         'High Confidence Anomaly': COLORS['anomaly']
     }
-    colors = [color_map.get(t, COLORS['secondary']) for t in type_counts['type']]
+    colors = [color_map.get(t, COLORS['secondary']) for t in types]
 
     fig = go.Figure(data=[go.Pie(
-        labels=type_counts['type'],
-        values=type_counts['count'],
+        labels=types,
+        values=counts,
         hole=0.4,
         marker=dict(colors=colors),
         textinfo='percent+label',
@@ -401,9 +563,9 @@ def main():
     # Load data
     try:
         with st.spinner('Loading and processing data...'):
-            detector = load_and_process_data()
+            detector = load_detector()
             df = detector.df
-            stats = detector.get_summary_stats()
+            stats = detector.summary_stats
     except FileNotFoundError:
         st.error("""
         **Data Files Not Found**
@@ -424,11 +586,11 @@ def main():
     st.sidebar.markdown("## FILTERS")
 
     # State filter
-    states = ['All'] + sorted(df['customer_state'].dropna().unique().tolist())
+    states = ['All'] + df['customer_state'].cat.categories.tolist()
     selected_state = st.sidebar.selectbox("State", states)
 
     # Anomaly type filter
-    anomaly_types = ['All'] + df['anomaly_type'].unique().tolist()
+    anomaly_types = ['All'] + df['anomaly_type'].cat.categories.tolist()
     selected_anomaly = st.sidebar.selectbox("Anomaly Type", anomaly_types)
 
     # Amount range filter
@@ -453,20 +615,8 @@ def main():
     )
 
     # Apply filters
-    filtered_df = df.copy()
-    if selected_state != 'All':
-        filtered_df = filtered_df[filtered_df['customer_state'] == selected_state]
-    if selected_anomaly != 'All':
-        filtered_df = filtered_df[filtered_df['anomaly_type'] == selected_anomaly]
-    filtered_df = filtered_df[
-        (filtered_df['total_amount'] >= amount_range[0]) &
-        (filtered_df['total_amount'] <= amount_range[1])
-    ]
-    if len(date_range) == 2:
-        filtered_df = filtered_df[
-            (filtered_df['order_purchase_timestamp'].dt.date >= date_range[0]) &
-            (filtered_df['order_purchase_timestamp'].dt.date <= date_range[1])
-        ]
+    filters = (selected_state, selected_anomaly, tuple(amount_range), tuple(date_range))
+    filtered_df = apply_filters(df, *filters)
 
     # Filter summary
     st.sidebar.markdown("---")
@@ -482,34 +632,33 @@ def main():
     col1, col2 = st.columns(2)
 
     with col1:
-        fig = create_distribution_chart(filtered_df)
+        fig = create_distribution_chart(amount_histogram(detector.data_version, *filters))
         st.plotly_chart(fig, use_container_width=True)
 
     with col2:
-        fig = create_anomaly_score_chart(filtered_df)
+        fig = create_anomaly_score_chart(score_histogram(detector.data_version, *filters))
         st.plotly_chart(fig, use_container_width=True)
 
     # Row 2: Time Series and Geographic
     col1, col2 = st.columns(2)
 
     with col1:
-        fig = create_time_series_chart(filtered_df)
+        fig = create_time_series_chart(monthly_aggregate(detector.data_version, *filters))
         st.plotly_chart(fig, use_container_width=True)
 
     with col2:
-        state_summary = detector.get_anomalies_by_state()
-        fig = create_state_chart(state_summary)
+        fig = create_state_chart(detector.top_states)
         st.plotly_chart(fig, use_container_width=True)
 
     # Row 3: Additional Analysis
     col1, col2 = st.columns(2)
 
     with col1:
-        fig = create_hourly_chart(filtered_df)
+        fig = create_hourly_chart(hourly_aggregate(detector.data_version, *filters))
         st.plotly_chart(fig, use_container_width=True)
 
     with col2:
-        fig = create_type_breakdown_chart(filtered_df)
+        fig = create_type_breakdown_chart(type_aggregate(detector.data_version, *filters))
         st.plotly_chart(fig, use_container_width=True)
 
     # Data Table Section
@@ -517,9 +666,7 @@ def main():
     st.subheader("Anomalous Transactions")
 
     # Show only anomalies
-    anomaly_df = filtered_df[filtered_df['is_anomaly_ml']].sort_values(
-        'anomaly_probability', ascending=False
-    )
+    anomaly_df = filtered_df[filtered_df['is_anomaly_ml'].values]
 
     if len(anomaly_df) > 0:
         # Select columns to display
@@ -527,11 +674,9 @@ def main():
             'order_id', 'customer_state', 'total_amount', 'total_items',
             'payment_installments', 'hour_of_day', 'anomaly_probability', 'anomaly_type'
         ]
-        display_df = anomaly_df[display_cols].head(100).copy()
-
-        # Format columns
-        display_df['total_amount'] = display_df['total_amount'].apply(lambda x: f"R$ {x:,.2f}")
-        display_df['anomaly_probability'] = display_df['anomaly_probability'].apply(lambda x: f"{x:.4f}")
+        # Top 100 by anomaly score: partition first, then sort only those rows
+        top = top_k(anomaly_df['anomaly_probability'].values, 100)
+        display_df = anomaly_df[display_cols].iloc[top].copy()
 
         # Rename columns for display
         display_df.columns = [
@@ -539,13 +684,21 @@ def main():
             'Installments', 'Hour', 'Anomaly Score', 'Type'
         ]
 
-        st.dataframe(display_df, use_container_width=True, height=400)
+        # Numbers are formatted client-side so the columns stay numeric (and sortable)
+        st.dataframe(
+            display_df,
+            use_container_width=True,
+            height=400,
+            column_config={
+                'Amount': st.column_config.NumberColumn(format='R$ %.2f'),
+                'Anomaly Score': st.column_config.NumberColumn(format='%.4f')
+            }
+        )
 
         # Download button
-        csv = anomaly_df.to_csv(index=False)
         st.download_button(
             label="Download Anomaly Data (CSV)",
-            data=csv,
+            data=anomalies_csv(detector.data_version, *filters),
             file_name="anomalous_transactions.csv",
             mime="text/csv"
         )
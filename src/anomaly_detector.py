@@ -5,13 +5,30 @@ Uses Isolation Forest and statistical methods to identify outliers
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import sklearn
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
 from pathlib import Path
 import duckdb
+import hashlib
+import joblib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
 
 
 class RetailAnomalyDetector:
+    # Indexed by is_anomaly_ml + 2 * is_anomaly_iqr
+    ANOMALY_TYPES = [
+        'Normal',
+        'ML Detected',
+        'Statistical Outlier',
+        'High Confidence Anomaly'
+    ]
+
     def __init__(self, contamination=0.05):
         self.contamination = contamination
         self.model = None
@@ -25,49 +42,110 @@ class RetailAnomalyDetector:
         ]
         self.df = None
 
-    def load_data(self, data_path=None):
-        """Load and merge all Olist datasets using DuckDB"""
-        if data_path is None:
-            # Get absolute path relative to this file's location
-            project_root = Path(__file__).parent.parent
-            data_path = str(project_root / 'data' / 'sample') + '/'
-
-        conn = duckdb.connect()
-
-        query = f"""
-        SELECT
-            o.order_id,
-            o.customer_id,
-            o.order_purchase_timestamp,
-            DATE_PART('hour', o.order_purchase_timestamp) AS hour_of_day,
-            DATE_PART('dow', o.order_purchase_timestamp) AS day_of_week,
-            oi.total_items,
-            oi.total_amount,
-            COALESCE(p.payment_installments, 1) AS payment_installments,
-            c.customer_state
-        FROM read_csv_auto('{data_path}olist_orders_dataset.csv') o
-        LEFT JOIN (
-            SELECT order_id, COUNT(*) AS total_items,
-                   SUM(price + freight_value) AS total_amount
-            FROM read_csv_auto('{data_path}olist_order_items_dataset.csv')
-            GROUP BY order_id
-        ) oi ON o.order_id = oi.order_id
-        LEFT JOIN (
-            SELECT order_id, MAX(payment_installments) AS payment_installments
-            FROM read_csv_auto('{data_path}olist_order_payments_dataset.csv')
-            GROUP BY order_id
-        ) p ON o.order_id = p.order_id
-        LEFT JOIN read_csv_auto('{data_path}olist_customers_dataset.csv') c
-            ON o.customer_id = c.customer_id
-        WHERE o.order_status = 'delivered'
-          AND oi.total_amount IS NOT NULL
+        # Fitted forests, keyed by a digest of their training data
+        self.model_cache_dir = Path(__file__).parent.parent / '.cache'
+
+        # One connection for the detector's lifetime; self.df is exposed to
+        # it as the `orders` view for the aggregation methods
+        self.conn = duckdb.connect(config={'threads': os.cpu_count() or 1})
+
+    def _query(self, query):
+        """Run SQL against the current frame, registered as `orders`"""
+        # Re-register so columns added since the last query are visible
+        self.conn.register('orders', self.df)
+        return self.conn.execute(query)
+
+    def load_data(self, data_path=None, conn=None, source_table='orders_enriched'):
+        """Load and merge all Olist datasets using DuckDB
+
+        If ``conn`` is given, features are selected from ``source_table`` on
+        that connection instead of re-parsing the CSVs. The default table is
+        the view OlistDataLoader.get_orders_enriched() creates, so call that
+        on the loader first.
         """
+        if conn is not None:
+            query = f"""
+            SELECT
+                order_id,
+                customer_id,
+                order_purchase_timestamp,
+                COALESCE(total_items, 0) AS total_items,
+                total_amount + COALESCE(total_freight, 0) AS total_amount,
+                COALESCE(payment_installments, 1) AS payment_installments,
+                customer_state
+            FROM {source_table}
+            WHERE order_status = 'delivered'
+              AND total_amount IS NOT NULL
+            """
+        else:
+            conn = self.conn
+            if data_path is None:
+                # Get absolute path relative to this file's location
+                project_root = Path(__file__).parent.parent
+                data_path = str(project_root / 'data' / 'sample') + '/'
+
+            query = f"""
+            SELECT
+                o.order_id,
+                o.customer_id,
+                o.order_purchase_timestamp,
+                COALESCE(oi.total_items, 0) AS total_items,
+                oi.total_amount,
+                COALESCE(p.payment_installments, 1) AS payment_installments,
+                c.customer_state
+            FROM read_csv_auto('{data_path}olist_orders_dataset.csv') o
+            LEFT JOIN (
+                SELECT order_id, COUNT(*) AS total_items,
+                       SUM(price + freight_value) AS total_amount
+                FROM read_csv_auto('{data_path}olist_order_items_dataset.csv')
+                GROUP BY order_id
+            ) oi ON o.order_id = oi.order_id
+            LEFT JOIN (
+                SELECT order_id, MAX(payment_installments) AS payment_installments
+                FROM read_csv_auto('{data_path}olist_order_payments_dataset.csv')
+                GROUP BY order_id
+            ) p ON o.order_id = p.order_id
+            LEFT JOIN read_csv_auto('{data_path}olist_customers_dataset.csv') c
+                ON o.customer_id = c.customer_id
+            WHERE o.order_status = 'delivered'
+              AND oi.total_amount IS NOT NULL
+            """
+
+        # Fetch through Arrow: fixed-width columns convert without an extra
+        # copy and the timestamp arrives already typed. Streaming record
+        # batches lets DuckDB release its result buffer as they are read
+        try:
+            reader = conn.execute(query).fetch_record_batch(65536)
+        except duckdb.CatalogException as exc:
+            if conn is self.conn:
+                raise
+            raise ValueError(
+                f"Source table '{source_table}' not found. "
+                "Call OlistDataLoader.get_orders_enriched() first."
+            ) from exc
+        tbl = pa.Table.from_batches(reader, schema=reader.schema)
+        self.df = tbl.to_pandas(split_blocks=True, self_destruct=True)
 
-        self.df = conn.execute(query).fetchdf()
-        self.df['order_purchase_timestamp'] = pd.to_datetime(
-            self.df['order_purchase_timestamp']
+        # Dictionary-encode the state so groupbys hash small integer codes
+        self.df['customer_state'] = self.df['customer_state'].astype('category')
+
+        # Hour and weekday by integer arithmetic on the timestamp ticks.
+        # 1970-01-01 was a Thursday; day_of_week counts from Sunday = 0.
+        # A missing timestamp gets 0 for both rather than a made-up value.
+        ts = self.df['order_purchase_timestamp'].to_numpy()
+        hours = ts.astype('datetime64[h]').view('i8')
+        missing = np.isnat(ts)
+        ts_loc = self.df.columns.get_loc('order_purchase_timestamp')
+        self.df.insert(
+            ts_loc + 1, 'hour_of_day',
+            np.where(missing, 0, hours % 24).astype(np.int8)
+        )
+        self.df.insert(
+            ts_loc + 2, 'day_of_week',
+            np.where(missing, 0, (hours // 24 + 4) % 7).astype(np.int8)
         )
-        conn.close()
+
+        self.conn.register('orders', self.df)
         return self.df
 
     def fit_isolation_forest(self):
@@ -75,51 +153,105 @@ class RetailAnomalyDetector:
         if self.df is None:
             raise ValueError("Data not loaded. Call load_data() first.")
 
-        X = self.df[self.feature_columns].fillna(0)
-        X_scaled = self.scaler.fit_transform(X)
+        # Isolation Forest trees split on float32, so build the feature matrix
+        # in that dtype once and let the scaler standardise it in place. The
+        # load query already COALESCEs the features, so no fillna copy
+        X = np.empty((len(self.df), len(self.feature_columns)), dtype=np.float32)
+        for i, col in enumerate(self.feature_columns):
+            X[:, i] = self.df[col].to_numpy()
+        self.scaler.fit(X)
+        X_scaled = self.scaler.transform(X, copy=False)
 
         self.model = IsolationForest(
             contamination=self.contamination,
             random_state=42,
-            n_estimators=100
+            n_estimators=100,
+            max_samples=256,
+            bootstrap=False,
+            n_jobs=-1
         )
 
-        self.df['anomaly_score'] = self.model.fit_predict(X_scaled)
-        self.df['anomaly_probability'] = -self.model.score_samples(X_scaled)
+        # Reuse a forest fitted on identical data with identical settings
+        digest = hashlib.blake2b(X_scaled.tobytes(), digest_size=8)
+        digest.update(repr(X_scaled.shape).encode())
+        digest.update(repr(sorted(self.model.get_params().items())).encode())
+        digest.update(sklearn.__version__.encode())
+        model_path = self.model_cache_dir / f'if_{digest.hexdigest()}.pkl'
+
+        cached = self._load_cached_model(model_path)
+        if cached is not None:
+            self.model = cached
+        else:
+            self.model.fit(X_scaled)
+            self._dump_cached_model(model_path)
+
+        # Score every sample once; predict() is the same scores thresholded
+        # at offset_, so there is no need for a second pass over the trees
+        scores = self.model.score_samples(X_scaled)
+        is_anomaly = scores < self.model.offset_
 
         # -1 = anomaly, 1 = normal
-        self.df['is_anomaly_ml'] = self.df['anomaly_score'] == -1
+        self.df['anomaly_score'] = np.where(is_anomaly, -1, 1)
+        self.df['anomaly_probability'] = -scores
+        self.df['is_anomaly_ml'] = is_anomaly
 
         return self
 
+    @staticmethod
+    def _load_cached_model(model_path):
+        """Load a cached forest, discarding the file if it is unreadable"""
+        if not model_path.exists():
+            return None
+        try:
+            return joblib.load(model_path)
+        except Exception as exc:
+            logger.warning("Discarding unreadable model cache %s: %s", model_path, exc)
+            model_path.unlink(missing_ok=True)
+            return None
+
+    def _dump_cached_model(self, model_path):
+        """Write the fitted forest to the cache; failures are not fatal"""
+        tmp_path = None
+        try:
+            self.model_cache_dir.mkdir(parents=True, exist_ok=True)
+            # Dump beside the target and rename, so an interrupted write
+            # never leaves a truncated pickle under the final name
+            fd, tmp_path = tempfile.mkstemp(dir=self.model_cache_dir, suffix='.tmp')
+            os.close(fd)
+            joblib.dump(self.model, tmp_path)
+            os.replace(tmp_path, model_path)
+        except OSError as exc:
+            logger.warning("Could not write model cache %s: %s", model_path, exc)
+            if tmp_path is not None:
+                Path(tmp_path).unlink(missing_ok=True)
+
     def add_statistical_flags(self):
         """Add Z-score and IQR based anomaly flags"""
         if self.df is None:
             raise ValueError("Data not loaded. Call load_data() first.")
 
+        # Amount statistics; both quartiles come from one percentile call
+        amounts = self.df['total_amount'].to_numpy()
+        mean_amt = amounts.mean()
+        std_amt = amounts.std(ddof=1)
+        q1, q3 = np.percentile(amounts, [25, 75])
+
         # Z-score for amount
-        mean_amt = self.df['total_amount'].mean()
-        std_amt = self.df['total_amount'].std()
-        self.df['amount_zscore'] = (self.df['total_amount'] - mean_amt) / std_amt
+        self.df['amount_zscore'] = (amounts - mean_amt) / std_amt
 
         # IQR method
-        q1 = self.df['total_amount'].quantile(0.25)
-        q3 = self.df['total_amount'].quantile(0.75)
         iqr = q3 - q1
-
         self.df['is_anomaly_iqr'] = (
-            (self.df['total_amount'] < q1 - 1.5 * iqr) |
-            (self.df['total_amount'] > q3 + 1.5 * iqr)
+            (amounts < q1 - 1.5 * iqr) | (amounts > q3 + 1.5 * iqr)
         )
 
-        # Combined flag
-        self.df['anomaly_type'] = 'Normal'
-        self.df.loc[self.df['is_anomaly_ml'], 'anomaly_type'] = 'ML Detected'
-        self.df.loc[self.df['is_anomaly_iqr'], 'anomaly_type'] = 'Statistical Outlier'
-        self.df.loc[
-            self.df['is_anomaly_ml'] & self.df['is_anomaly_iqr'],
-            'anomaly_type'
-        ] = 'High Confidence Anomaly'
+        # Combined flag: pack both booleans into one category code
+        is_ml = self.df['is_anomaly_ml'].to_numpy()
+        is_iqr = self.df['is_anomaly_iqr'].to_numpy()
+        codes = is_ml.astype(np.int8) + 2 * is_iqr.astype(np.int8)
+        self.df['anomaly_type'] = pd.Categorical.from_codes(
+            codes, categories=self.ANOMALY_TYPES
+        )
 
         return self
 
@@ -128,56 +260,71 @@ class RetailAnomalyDetector:
         if self.df is None:
             raise ValueError("Data not loaded. Call load_data() first.")
 
-        summary = {
-            'total_orders': len(self.df),
-            'total_revenue': self.df['total_amount'].sum(),
-            'anomaly_count_ml': self.df['is_anomaly_ml'].sum(),
-            'anomaly_count_iqr': self.df['is_anomaly_iqr'].sum(),
-            'anomaly_rate_ml': self.df['is_anomaly_ml'].mean() * 100,
-            'anomaly_revenue': self.df.loc[
-                self.df['is_anomaly_ml'], 'total_amount'
-            ].sum(),
-            'avg_normal_order': self.df.loc[
-                ~self.df['is_anomaly_ml'], 'total_amount'
-            ].mean(),
-            'avg_anomaly_order': self.df.loc[
-                self.df['is_anomaly_ml'], 'total_amount'
-            ].mean(),
+        # All figures come from one aggregate pass over the frame
+        result = self._query("""
+            SELECT
+                COUNT(*) AS total_orders,
+                COALESCE(SUM(total_amount), 0) AS total_revenue,
+                COUNT(*) FILTER (WHERE is_anomaly_ml) AS anomaly_count_ml,
+                COUNT(*) FILTER (WHERE is_anomaly_iqr) AS anomaly_count_iqr,
+                AVG(CAST(is_anomaly_ml AS INTEGER)) * 100 AS anomaly_rate_ml,
+                COALESCE(SUM(total_amount) FILTER (WHERE is_anomaly_ml), 0) AS anomaly_revenue,
+                AVG(total_amount) FILTER (WHERE NOT is_anomaly_ml) AS avg_normal_order,
+                AVG(total_amount) FILTER (WHERE is_anomaly_ml) AS avg_anomaly_order
+            FROM orders
+        """)
+        columns = [col[0] for col in result.description]
+        # SQL averages over an empty subset are NULL; pandas gave NaN
+        return {
+            col: float('nan') if value is None else value
+            for col, value in zip(columns, result.fetchone())
         }
-        return summary
 
     def get_anomalies_by_state(self):
         """Aggregate anomalies by state"""
         if self.df is None:
             raise ValueError("Data not loaded. Call load_data() first.")
 
-        return self.df.groupby('customer_state').agg({
-            'order_id': 'count',
-            'is_anomaly_ml': 'sum',
-            'total_amount': 'sum'
-        }).rename(columns={
-            'order_id': 'total_orders',
-            'is_anomaly_ml': 'anomaly_count'
-        }).assign(
-            anomaly_rate=lambda x: x['anomaly_count'] / x['total_orders'] * 100
-        ).sort_values('anomaly_count', ascending=False)
+        return self._query("""
+            SELECT
+                customer_state,
+                COUNT(*) AS total_orders,
+                COUNT(*) FILTER (WHERE is_anomaly_ml) AS anomaly_count,
+                SUM(total_amount) AS total_amount,
+                COUNT(*) FILTER (WHERE is_anomaly_ml) * 100.0 / COUNT(*) AS anomaly_rate
+            FROM orders
+            WHERE customer_state IS NOT NULL
+            GROUP BY customer_state
+            ORDER BY anomaly_count DESC, customer_state
+        """).fetchdf().set_index('customer_state')
 
     def get_monthly_trends(self):
         """Get monthly anomaly trends"""
         if self.df is None:
             raise ValueError("Data not loaded. Call load_data() first.")
 
-        monthly = self.df.groupby(
-            self.df['order_purchase_timestamp'].dt.to_period('M')
-        ).agg({
-            'order_id': 'count',
-            'is_anomaly_ml': 'sum',
-            'total_amount': 'sum'
-        }).reset_index()
-        monthly['order_purchase_timestamp'] = monthly['order_purchase_timestamp'].astype(str)
-        monthly['anomaly_rate'] = monthly['is_anomaly_ml'] / monthly['order_id'] * 100
-        monthly.columns = ['month', 'total_orders', 'anomaly_count', 'total_revenue', 'anomaly_rate']
-        return monthly
+        return self._query("""
+            SELECT
+                strftime(month_start, '%Y-%m') AS month,
+                total_orders,
+                anomaly_count,
+                total_revenue,
+                anomaly_count * 100.0 / total_orders AS anomaly_rate
+            FROM (
+                SELECT
+                    date_trunc('month', order_purchase_timestamp) AS month_start,
+                    COUNT(*) AS total_orders,
+                    COUNT(*) FILTER (WHERE is_anomaly_ml) AS anomaly_count,
+                    SUM(total_amount) AS total_revenue
+                FROM orders
+                GROUP BY month_start
+            )
+            ORDER BY month_start
+        """).fetchdf()
+
+    def close(self):
+        """Close database connection"""
+        self.conn.close()
 
 
 if __name__ == "__main__":
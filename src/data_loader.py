@@ -4,7 +4,10 @@ Utility functions for loading and preprocessing Olist e-commerce data
 """
 
 import pandas as pd
+import numpy as np
 import duckdb
+import os
+import tempfile
 from pathlib import Path
 
 
@@ -22,10 +25,36 @@ class OlistDataLoader:
         'olist_geolocation_dataset.csv'
     ]
 
+    # Source files behind get_orders_enriched(), used to invalidate its cache
+    ENRICHED_SOURCE_FILES = [
+        'olist_orders_dataset.csv',
+        'olist_order_items_dataset.csv',
+        'olist_customers_dataset.csv',
+        'olist_order_payments_dataset.csv'
+    ]
+
+    # Payment types by bit position in payment_type_mask
+    PAYMENT_TYPES = [
+        'credit_card',
+        'boleto',
+        'voucher',
+        'debit_card',
+        'not_defined'
+    ]
+
+    # Version of the get_orders_enriched() projection, part of the cache file
+    # name; bump it whenever the enriched query's columns change
+    CACHE_VERSION = 3
+
     def __init__(self, data_path: str = 'data/sample/'):
         self.data_path = Path(data_path)
+        self.cache_path = (
+            self.data_path / 'cache' / f'orders_enriched_v{self.CACHE_VERSION}.parquet'
+        )
         self.conn = duckdb.connect()
         self.tables = {}
+        # CSV modification time at the point each table was parsed
+        self._table_mtimes = {}
 
     def check_data_exists(self) -> dict:
         """Check which dataset files exist"""
@@ -35,20 +64,114 @@ class OlistDataLoader:
             status[file] = file_path.exists()
         return status
 
+    def _create_table(self, file: str) -> str:
+        """Parse one CSV into a DuckDB table named after the file"""
+        file_path = self.data_path / file
+        table_name = file.replace('olist_', '').replace('_dataset.csv', '')
+        self._table_mtimes[table_name] = file_path.stat().st_mtime
+        self.conn.execute(
+            f"CREATE OR REPLACE TABLE {table_name} AS "
+            f"SELECT * FROM read_csv_auto('{file_path}')"
+        )
+        self.tables[table_name] = self.conn.table(table_name)
+        if table_name == 'customers':
+            self._create_state_type()
+        return table_name
+
+    def _create_state_type(self):
+        """Define the state_t ENUM from the states present in customers"""
+        # Joins and groupbys on an ENUM compare small integer codes rather
+        # than strings; rebuilt whenever the customers table is reloaded
+        self.conn.execute("DROP TYPE IF EXISTS state_t")
+        self.conn.execute(
+            "CREATE TYPE state_t AS ENUM ("
+            "SELECT DISTINCT customer_state FROM customers "
+            "WHERE customer_state IS NOT NULL ORDER BY customer_state)"
+        )
+
+    def _require_tables(self, *files: str):
+        """Create the tables for any of the given files not loaded yet
+
+        Tables whose CSV has changed since it was parsed are re-created too.
+        """
+        for file in files:
+            table_name = file.replace('olist_', '').replace('_dataset.csv', '')
+            if (
+                table_name not in self.tables
+                or (self.data_path / file).stat().st_mtime
+                > self._table_mtimes[table_name]
+            ):
+                self._create_table(file)
+
     def load_all_tables(self) -> dict:
-        """Load all CSV files into DuckDB tables"""
+        """Load all CSV files into DuckDB tables
+
+        Each file is parsed once; ``self.tables`` maps table names to DuckDB
+        relations that the query methods below read from.
+        """
         for file in self.DATASET_FILES:
-            file_path = self.data_path / file
-            if file_path.exists():
-                table_name = file.replace('olist_', '').replace('_dataset.csv', '')
-                self.tables[table_name] = self.conn.execute(
-                    f"SELECT * FROM read_csv_auto('{file_path}')"
-                ).fetchdf()
-                print(f"Loaded {table_name}: {len(self.tables[table_name]):,} rows")
+            if (self.data_path / file).exists():
+                table_name = self._create_table(file)
+                row_count = self.conn.execute(
+                    f"SELECT COUNT(*) FROM {table_name}"
+                ).fetchone()[0]
+                print(f"Loaded {table_name}: {row_count:,} rows")
         return self.tables
 
+    def _cache_is_fresh(self) -> bool:
+        """Check the Parquet cache exists and is newer than its source CSVs"""
+        if not self.cache_path.exists():
+            return False
+        cache_mtime = self.cache_path.stat().st_mtime
+        return all(
+            (self.data_path / file).stat().st_mtime <= cache_mtime
+            for file in self.ENRICHED_SOURCE_FILES
+        )
+
     def get_orders_enriched(self) -> pd.DataFrame:
-        """Get enriched orders with items, payments, and customer info"""
+        """Get enriched orders with items, payments, and customer info
+
+        The joined result is cached as Parquet under ``data_path/cache`` so
+        later calls skip CSV parsing until a source file changes. It is also
+        exposed on ``self.conn`` as the ``orders_enriched`` view, which
+        ``RetailAnomalyDetector.load_data`` can select from directly.
+        """
+        if not self._cache_is_fresh():
+            self._build_orders_enriched_cache()
+
+        try:
+            self._create_enriched_view()
+        except duckdb.Error:
+            # An unreadable cache file is as good as stale
+            self._build_orders_enriched_cache()
+            self._create_enriched_view()
+
+        tbl = self.conn.execute("SELECT * FROM orders_enriched").fetch_arrow_table()
+        df = tbl.to_pandas(split_blocks=True, self_destruct=True)
+        df.insert(
+            df.columns.get_loc('payment_type_mask'),
+            'payment_type',
+            self._decode_payment_types(df['payment_type_mask'])
+        )
+        # Parquet stores the ENUM as plain strings; restore the dictionary
+        df['customer_state'] = df['customer_state'].astype('category')
+        return df
+
+    def _create_enriched_view(self):
+        """Expose the Parquet cache as the orders_enriched view"""
+        self.conn.execute(
+            "CREATE OR REPLACE VIEW orders_enriched AS "
+            f"SELECT * FROM read_parquet('{self.cache_path}')"
+        )
+
+    def _build_orders_enriched_cache(self):
+        """Run the enriched orders join and write it to the Parquet cache"""
+        self._require_tables(*self.ENRICHED_SOURCE_FILES)
+        bits = ' '.join(
+            f"WHEN '{name}' THEN {1 << bit}"
+            for bit, name in enumerate(self.PAYMENT_TYPES)
+        )
+        other_bit = 1 << self.PAYMENT_TYPES.index('not_defined')
         query = f"""
         SELECT
             o.order_id,
@@ -74,14 +197,14 @@ class OlistDataLoader:
 
             -- Customer info
             c.customer_city,
-            c.customer_state,
+            c.customer_state::state_t AS customer_state,
 
             -- Payment info
-            p.payment_type,
+            p.payment_type_mask,
             p.payment_installments,
             p.payment_value
 
-        FROM read_csv_auto('{self.data_path}/olist_orders_dataset.csv') o
+        FROM orders o
 
         LEFT JOIN (
             SELECT
@@ -90,41 +213,70 @@ class OlistDataLoader:
                 SUM(price) AS total_amount,
                 SUM(freight_value) AS total_freight,
                 AVG(price) AS avg_item_price
-            FROM read_csv_auto('{self.data_path}/olist_order_items_dataset.csv')
+            FROM order_items
             GROUP BY order_id
         ) oi ON o.order_id = oi.order_id
 
-        LEFT JOIN read_csv_auto('{self.data_path}/olist_customers_dataset.csv') c
+        LEFT JOIN customers c
             ON o.customer_id = c.customer_id
 
         LEFT JOIN (
             SELECT
                 order_id,
-                STRING_AGG(DISTINCT payment_type, ', ') AS payment_type,
+                -- Distinct payment types packed as bits (unknown types count
+                -- as not_defined); decoded to labels after fetch
+                CAST(BIT_OR(CASE payment_type {bits} ELSE {other_bit} END) AS UTINYINT)
+                    AS payment_type_mask,
                 MAX(payment_installments) AS payment_installments,
                 SUM(payment_value) AS payment_value
-            FROM read_csv_auto('{self.data_path}/olist_order_payments_dataset.csv')
+            FROM order_payments
             GROUP BY order_id
         ) p ON o.order_id = p.order_id
 
         WHERE o.order_status = 'delivered'
         """
 
-        df = self.conn.execute(query).fetchdf()
-        df['order_purchase_timestamp'] = pd.to_datetime(df['order_purchase_timestamp'])
-        return df
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # COPY writes its target in place, so write beside the cache and
+        # rename; an interrupted build never leaves a truncated file that
+        # _cache_is_fresh() would accept
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_path.parent, suffix='.tmp')
+        os.close(fd)
+        try:
+            self.conn.execute(
+                f"COPY ({query}) TO '{tmp_path}' (FORMAT PARQUET, COMPRESSION ZSTD)"
+            )
+            os.replace(tmp_path, self.cache_path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def _decode_payment_types(self, masks: pd.Series) -> np.ndarray:
+        """Map payment type bitmasks back to comma-separated labels"""
+        # Every possible mask gets its label once; rows are a table lookup
+        labels = np.array([None] + [
+            ', '.join(
+                name for bit, name in enumerate(self.PAYMENT_TYPES)
+                if mask & (1 << bit)
+            )
+            for mask in range(1, 1 << len(self.PAYMENT_TYPES))
+        ], dtype=object)
+        return labels[masks.fillna(0).to_numpy(dtype=np.int64)]
 
     def get_product_categories(self) -> pd.DataFrame:
         """Get product category summary"""
-        query = f"""
+        self._require_tables(
+            'olist_order_items_dataset.csv', 'olist_products_dataset.csv'
+        )
+        query = """
         SELECT
             p.product_category_name,
             COUNT(DISTINCT oi.product_id) AS product_count,
             COUNT(DISTINCT oi.order_id) AS order_count,
             SUM(oi.price) AS total_revenue,
             AVG(oi.price) AS avg_price
-        FROM read_csv_auto('{self.data_path}/olist_order_items_dataset.csv') oi
-        LEFT JOIN read_csv_auto('{self.data_path}/olist_products_dataset.csv') p
+        FROM order_items oi
+        LEFT JOIN products p
             ON oi.product_id = p.product_id
         GROUP BY p.product_category_name
         ORDER BY total_revenue DESC
@@ -133,7 +285,10 @@ class OlistDataLoader:
 
     def get_seller_performance(self) -> pd.DataFrame:
         """Get seller performance metrics"""
-        query = f"""
+        self._require_tables(
+            'olist_order_items_dataset.csv', 'olist_sellers_dataset.csv'
+        )
+        query = """
         SELECT
             s.seller_id,
             s.seller_city,
@@ -141,8 +296,8 @@ class OlistDataLoader:
             COUNT(DISTINCT oi.order_id) AS order_count,
             SUM(oi.price) AS total_revenue,
             AVG(oi.price) AS avg_order_value
-        FROM read_csv_auto('{self.data_path}/olist_order_items_dataset.csv') oi
-        LEFT JOIN read_csv_auto('{self.data_path}/olist_sellers_dataset.csv') s
+        FROM order_items oi
+        LEFT JOIN sellers s
             ON oi.seller_id = s.seller_id
         GROUP BY s.seller_id, s.seller_city, s.seller_state
         ORDER BY total_revenue DESC